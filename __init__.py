@@ -37,11 +37,16 @@ __version__ = u'0.9-beta2'
 
 
 import sys
+import json
 import argparse
 import traceback
 import re
 import os
 import os.path
+import stat
+import errno
+import signal
+import socket
 # XSD validation: removed
 #import pystache
 import termcolor
@@ -51,6 +56,11 @@ import inspect
 import tempfile
 import mimetypes
 import xml.dom.minidom
+import threading
+import Queue
+import urlparse
+import BaseHTTPServer
+import SocketServer
 # XSD validation: removed
 #import lxml.etree
 import mutagen
@@ -95,11 +105,83 @@ def sanitize(string):
     return BAD_CHARACTERS.sub("_", string)
 
 
+def positive_int(string):
+
+    '''Convert a command line argument to a positive integer'''
+
+    try:
+        value = int(string)
+    except ValueError:
+        value = 0
+
+    if value < 1:
+        raise argparse.ArgumentTypeError("'{0}' is not a positive integer".format(string))
+
+    return value
+
+
 ####################
 # OUTPUT FUNCTIONS #
 ####################
 
 
+class OutputSink(threading.local):
+
+    '''
+    Destination of the program output, kept separately for every thread so
+    that the concurrent requests of the server do not mix their events
+    '''
+
+    def __init__(self):
+
+        # 'text' for the colored terminal output, 'json' for one event per line
+        self.format = u'text'
+
+        # when not None, the JSON events are collected here instead of being
+        # printed on stdout
+        self.events = None
+
+        # album and stage the following events refer to
+        self.album  = None
+        self.stage  = None
+
+
+OUTPUT = OutputSink()
+
+
+def emit_event(event, **fields):
+
+    '''
+    Emit a JSON event, in the form:
+    {"event": <event>, "album": <album>, "stage": <stage>, ...}
+    '''
+
+    fields['event'] = event
+    fields.setdefault('album', OUTPUT.album)
+    fields.setdefault('stage', OUTPUT.stage)
+
+    if OUTPUT.events is not None:
+        OUTPUT.events.append(fields)
+    else:
+        print(json.dumps(fields))
+
+
+def print_album(name):
+
+    '''
+    Print the name of the album being processed, in the form:
+    ### <album>
+    '''
+
+    OUTPUT.album = name
+    OUTPUT.stage = None
+
+    if OUTPUT.format == u'json':
+        emit_event(u'album')
+    else:
+        print(termcolor.colored('### ', 'blue', attrs = [ 'bold' ]) + name)
+
+
 def print_header(msg):
 
     '''
@@ -107,7 +189,12 @@ def print_header(msg):
     >>> <intestazione>
     '''
     
-    print(termcolor.colored('>>> ', 'green', attrs = [ 'bold' ]) + msg)
+    OUTPUT.stage = msg
+
+    if OUTPUT.format == u'json':
+        emit_event(u'stage')
+    else:
+        print(termcolor.colored('>>> ', 'green', attrs = [ 'bold' ]) + msg)
 
 
 def print_item(msg):
@@ -117,7 +204,23 @@ def print_item(msg):
     --> <elemento>
     '''
 
-    print(termcolor.colored('--> ', 'yellow', attrs = [ 'bold' ]) + msg)
+    if OUTPUT.format == u'json':
+        emit_event(u'item', message = msg)
+    else:
+        print(termcolor.colored('--> ', 'yellow', attrs = [ 'bold' ]) + msg)
+
+
+def print_error(msg):
+
+    '''
+    Print an error message, in the form:
+    !!! <errore>
+    '''
+
+    if OUTPUT.format == u'json':
+        emit_event(u'error', message = msg)
+    else:
+        print(termcolor.colored('!!! ', 'red', attrs = [ 'bold' ]) + msg)
 
 
 ####################
@@ -257,10 +360,11 @@ class Album:
                 print_item(item)
 
 
-    def check_filenames(self):
+    def check_filenames(self, lock_directory = None):
 
         '''Controlla se i nomi dei file e della directory dell'album sono coerenti
-        con il file di configurazione'''
+        con il file di configurazione; se indicata, `lock_directory` viene
+        chiamata con la nuova directory prima di rinominare quella attuale'''
 
         print_header("Controllo i nomi dei file")
 
@@ -282,8 +386,12 @@ class Album:
         if self.directory != new_album_dir:
             # rinomina la directory dell'album
             print_item("Album directory:  '" + os.path.split(self.directory)[1] + "'  -->  '" + os.path.split(new_album_dir)[1] + "'")
+            if lock_directory is not None:
+                lock_directory(new_album_dir)
             os.rename(self.directory, new_album_dir)
             self.directory = new_album_dir
+            # i messaggi seguenti si riferiscono alla nuova directory
+            OUTPUT.album = os.path.split(self.directory)[1]
 
         # se l'album ha un solo disco
         if self.single_disc:
@@ -317,9 +425,10 @@ class Album:
                 os.rename(audiofiles[item], new_track_name)
 
 
-    def check_metadata(self):
+    def check_metadata(self, jobs = 1):
 
-        '''Controlla i metadati dei file audio'''
+        '''Controlla i metadati dei file audio, aggiornando fino a `jobs`
+        tracce contemporaneamente'''
 
         print_header("Controllo i metadati")
         
@@ -335,59 +444,116 @@ class Album:
                 for track in disc[1]:
                     tracklist.append([disc_title , track])
 
-        for idx in range(len(self.audiofiles)):
-            print_item("'" + os.path.split(self.audiofiles[idx])[1] + "'")
-            # apri il file con mutagen
-            if mimetypes.guess_type(self.audiofiles[idx])[0] == "audio/mpeg":
-                easy_mode = True
-            else:
-                easy_mode = False
-            item = mutagen.File(self.audiofiles[idx], easy = easy_mode)
-            # cancella i vecchi tag
-            item.delete()
-            # se l'album e' uno split
-            if self.is_split:
-                # se l'indice dell'elemento attuale e' minore (solo minore
-                # perche' idx parte da zero) all'indice dello split
-                if idx < self.split_index:
-                    # usa il nome del primo autore
-                    item["artist"] = self.author[0]
-                else:
-                    # usa il nome del secondo autore
-                    item["artist"] = self.author[1]
-            else:
-                # c'e' un solo autore, usa quello
-                item["artist"] = self.author
-            item["album"] = self.title
-            # se l'album ha un solo disco
-            if self.single_disc:
-                item["title"] = tracklist[idx]
+        # leggi una sola volta l'elenco dei file e la copertina
+        audiofiles = self.audiofiles
+        cover_data = open(self.cover_image, "rb").read()
+
+        # le tracce da aggiornare, nell'ordine dell'album
+        pending = Queue.Queue()
+        for idx in range(len(audiofiles)):
+            pending.put(idx)
+
+        # segnala la fine dell'aggiornamento di ogni traccia
+        done = [ threading.Event() for audiofile in audiofiles ]
+        errors = {}
+        aborted = threading.Event()
+
+        def worker():
+            # le tracce vengono prelevate in ordine, quindi quando si
+            # interrompe il lavoro tutte quelle precedenti alla traccia
+            # fallita sono gia' state completate
+            while not aborted.is_set():
+                try:
+                    idx = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.__update_track_metadata(idx, audiofiles[idx], tracklist, cover_data)
+                except Exception, e:
+                    errors[idx] = e
+                    aborted.set()
+                finally:
+                    done[idx].set()
+
+        workers = [ threading.Thread(target = worker) for n in range(max(1, min(jobs, len(audiofiles)))) ]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            # stampa le tracce nell'ordine dell'album, man mano che vengono
+            # completate; l'output resta nel thread chiamante
+            for idx in range(len(audiofiles)):
+                # senza timeout l'attesa non puo' essere interrotta con Ctrl-C
+                while not done[idx].wait(0.5):
+                    pass
+                print_item("'" + os.path.split(audiofiles[idx])[1] + "'")
+                if idx in errors:
+                    raise Exception(os.path.split(audiofiles[idx])[1] + ": " + unicode(errors[idx]))
+        finally:
+            # ferma i thread dopo la traccia in corso, anche in caso di
+            # interruzione da tastiera
+            aborted.set()
+            for thread in workers:
+                while thread.is_alive():
+                    thread.join(0.5)
+
+
+    def __update_track_metadata(self, idx, audiofile, tracklist, cover_data):
+
+        '''Riscrive i metadati di una singola traccia'''
+
+        # apri il file con mutagen
+        if mimetypes.guess_type(audiofile)[0] == "audio/mpeg":
+            easy_mode = True
+        else:
+            easy_mode = False
+        item = mutagen.File(audiofile, easy = easy_mode)
+        # cancella i vecchi tag
+        item.delete()
+        # se l'album e' uno split
+        if self.is_split:
+            # se l'indice dell'elemento attuale e' minore (solo minore
+            # perche' idx parte da zero) all'indice dello split
+            if idx < self.split_index:
+                # usa il nome del primo autore
+                item["artist"] = self.author[0]
             else:
-                item["title"] = tracklist[idx][1]
-                # inserisci anche il titolo del disco
-                # convertito a stringa per i dischi che non hanno un proprio titolo,
-                # ma non se il file e' un MP4
-                if not isinstance(item, mutagen.mp4.MP4):
-                    item["discsubtitle"] = str(tracklist[idx][0])
-            item["genre"] = self.genre
-            item["date"] = self.year
-            item["tracknumber"] = unicode(str(idx + 1) + "/" + str(len(tracklist)))
+                # usa il nome del secondo autore
+                item["artist"] = self.author[1]
+        else:
+            # c'e' un solo autore, usa quello
+            item["artist"] = self.author
+        item["album"] = self.title
+        # se l'album ha un solo disco
+        if self.single_disc:
+            item["title"] = tracklist[idx]
+        else:
+            item["title"] = tracklist[idx][1]
+            # inserisci anche il titolo del disco
+            # convertito a stringa per i dischi che non hanno un proprio titolo,
+            # ma non se il file e' un MP4
+            if not isinstance(item, mutagen.mp4.MP4):
+                item["discsubtitle"] = str(tracklist[idx][0])
+        item["genre"] = self.genre
+        item["date"] = self.year
+        item["tracknumber"] = unicode(str(idx + 1) + "/" + str(len(tracklist)))
+        # salva il file
+        item.save()
+        # se il file e' un mp3
+        if isinstance(item, mutagen.mp3.EasyMP3):
+            # crea il frame ID3 contenente l'immagine
+            item_image = mutagen.id3.APIC(encoding = 3, mime = 'image/jpeg', type = 3, desc = 'Front cover', data = cover_data)
+            item = mutagen.id3.ID3(audiofile)
+            # aggiungilo al file
+            item.add(item_image)
+            # salva il file
+            item.save()
+        elif isinstance(item, mutagen.mp4.MP4):
+            # assegna la copertina
+            item["covr"] = [ mutagen.mp4.MP4Cover(cover_data) ]
             # salva il file
             item.save()
-            # se il file e' un mp3
-            if isinstance(item, mutagen.mp3.EasyMP3):
-                # crea il frame ID3 contenente l'immagine
-                item_image = mutagen.id3.APIC(encoding = 3, mime = 'image/jpeg', type = 3, desc = 'Front cover', data = open(self.cover_image, "rb").read())
-                item = mutagen.id3.ID3(self.audiofiles[idx])
-                # aggiungilo al file
-                item.add(item_image)
-                # salva il file
-                item.save()
-            elif isinstance(item, mutagen.mp4.MP4):
-                # assegna la copertina
-                item["covr"] = [ mutagen.mp4.MP4Cover(open(self.cover_image, "rb").read()) ]
-                # salva il file
-                item.save()
 
 
     def check_crlf(self):
@@ -395,33 +561,46 @@ class Album:
         '''Converte il file di configurazione in formato DOS'''
 
         # leggi il contenuto del file
-        config_data = open(self.config_file, "r").read().splitlines()
+        config = open(self.config_file, "r")
+        config_data = config.read().splitlines()
+        config.close()
 
         # sostituisci i delimitatori di fine linea con la versione DOS
         config_data = map(lambda line: line + "\r\n", config_data)
 
-        # scrivi il file convertito
-        out = open(self.config_file, "w")
+        # scrivi il file convertito in un file temporaneo nella stessa
+        # directory, cosi' chi legge il file non lo vede mai incompleto
+        fd, tmp_file = tempfile.mkstemp(prefix = ".", suffix = ".tmp", dir = self.directory)
+        try:
+            out = os.fdopen(fd, "w")
+            out.write("".join(config_data))
+            out.close()
+            # mantieni i permessi del file originale
+            shutil.copymode(self.config_file, tmp_file)
+            # sostituisci il file originale
+            os.rename(tmp_file, self.config_file)
+        except:
+            os.remove(tmp_file)
+            raise
 
-        # scrivi il file
-        out.write(reduce(lambda x,y: x + y, config_data))
 
-
-    def check(self):
+    def check(self, jobs = 1, lock_directory = None):
 
         '''Esegue tutti i controlli di consistenza sull'album'''
 
-        print(termcolor.colored('### ', 'blue', attrs = [ 'bold' ]) + os.path.split(self.directory)[1])
+        print_album(os.path.split(self.directory)[1])
         
         # esegui tutti i controlli
-        self.check_filenames()
-        self.check_metadata()
+        self.check_filenames(lock_directory)
+        self.check_metadata(jobs)
         self.check_unknown_files()
         self.check_crlf()
         
 
-    def dump(self):
-        
+    def metadata(self):
+
+        '''Restituisce i dati principali dell'album'''
+
         obj = {
             'author': self.author,
             'title':  self.title,
@@ -431,8 +610,35 @@ class Album:
         
         if self.is_split:
             obj['split'] = self.split_index
-        
-        print yaml.dump(obj)
+
+        return obj
+
+
+    def matches(self, **filters):
+
+        '''Controlla se l'album corrisponde ai filtri indicati (senza
+        distinzione tra maiuscole e minuscole)'''
+
+        for key, value in filters.items():
+            if value is None:
+                continue
+            field = getattr(self, key)
+            # negli split gli autori sono piu' di uno
+            if not isinstance(field, list):
+                field = [ field ]
+            if value.lower() not in [ unicode(f).lower() for f in field ]:
+                return False
+        return True
+
+
+    def dump(self):
+
+        OUTPUT.album = os.path.split(self.directory)[1]
+
+        if OUTPUT.format == u'json':
+            emit_event(u'dump', metadata = self.metadata())
+        else:
+            print yaml.dump(self.metadata())
 
         
     def __get_audiofiles(self):
@@ -447,6 +653,91 @@ class Album:
         return audiofiles
 
 
+class Catalogue:
+
+
+    '''
+    Cache of the loaded albums, shared by the threads of the server.
+    An album is reloaded as soon as its directory or its configuration file
+    are modified.
+    Every album directory also has a lock, held while the album is checked
+    or loaded, so that a check never runs together with another check or
+    with a reader of the same album.
+    '''
+
+
+    def __init__(self):
+
+        self.albums      = {}
+        self.album_locks = {}
+        self.lock        = threading.Lock()
+
+
+    def lock_album(self, album_dir):
+
+        '''Wait until no other thread is using the given album directory'''
+
+        with self.lock:
+            lock = self.album_locks.setdefault(album_dir, threading.Lock())
+
+        lock.acquire()
+
+
+    def unlock_album(self, album_dir):
+
+        '''Let other threads use the given album directory'''
+
+        with self.lock:
+            lock = self.album_locks[album_dir]
+
+        lock.release()
+
+
+    def get(self, album_dir):
+
+        '''Return the Album stored in the given directory'''
+
+        self.lock_album(album_dir)
+        try:
+            return self.__load(album_dir)
+        finally:
+            self.unlock_album(album_dir)
+
+
+    def __load(self, album_dir):
+
+        config_file = os.path.join(album_dir, METADATA_FILE)
+
+        # let Album report the missing configuration file
+        if not os.path.isfile(config_file):
+            return Album(album_dir)
+
+        key = (os.path.getmtime(album_dir), os.path.getmtime(config_file))
+
+        with self.lock:
+            cached = self.albums.get(album_dir)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+
+        album = Album(album_dir)
+
+        with self.lock:
+            self.albums[album_dir] = (key, album)
+
+        return album
+
+
+    def discard(self, album_dir):
+
+        '''Forget the album stored in the given directory'''
+
+        with self.lock:
+            self.albums.pop(album_dir, None)
+
+
+CATALOGUE = Catalogue()
+
+
 ###########
 # ACTIONS #
 ###########
@@ -460,12 +751,20 @@ class ActionExecutor:
     
     def print_genres(self, args):
     
-        print(os.linesep.join(VALID_GENRES))
+        if OUTPUT.format == u'json':
+            emit_event(u'genres', genres = VALID_GENRES)
+        else:
+            print(os.linesep.join(VALID_GENRES))
 
 
     def print_commands(self, args):
 
-        print(os.linesep.join([ name for name in self.__class__.__dict__ if inspect.ismethod(getattr(self.__class__, name)) ]))
+        commands = [ name for name in self.__class__.__dict__ if inspect.ismethod(getattr(self.__class__, name)) ]
+
+        if OUTPUT.format == u'json':
+            emit_event(u'commands', commands = commands)
+        else:
+            print(os.linesep.join(commands))
 
 
     def init_album(self, args):
@@ -476,10 +775,10 @@ class ActionExecutor:
         # http://code.activestate.com/recipes/66434-change-line-endings/
     
         if not os.path.isdir(args.path):
-            raise argparse.ArgumentError("'{0}' is not a valid path".format(args.path))
+            raise Exception("'{0}' is not a valid path".format(args.path))
 
         if not os.access(args.path, os.R_OK):
-            raise argparse.ArgumentError("'{0}' is not a readable dir".format(args.path))
+            raise Exception("'{0}' is not a readable dir".format(args.path))
 
         # determine the path to the metadata file
         metadata_file = os.path.join(os.path.realpath(args.path), METADATA_FILE)
@@ -501,16 +800,37 @@ class ActionExecutor:
         '''Perform a consistency check on the given album'''
     
         if not os.path.isdir(args.path):
-            raise argparse.ArgumentError("'{0}' is not a valid path".format(args.path))
+            raise Exception("'{0}' is not a valid path".format(args.path))
 
         if not os.access(args.path, os.R_OK):
-            raise argparse.ArgumentError("'{0}' is not a readable dir".format(args.path))
+            raise Exception("'{0}' is not a readable dir".format(args.path))
+
+        # the server passes the arguments as they are
+        try:
+            jobs = positive_int(args.jobs)
+        except argparse.ArgumentTypeError, e:
+            raise Exception("jobs: " + unicode(e))
 
         # determine the path to the metadata file
         path = unicode(os.path.realpath(args.path), "utf-8")
 
-        # create the Album object
-        Album(path).check()
+        # the check renames and rewrites the files of the album: keep the
+        # other requests away from both its current and its new directory
+        locked = []
+
+        def lock_directory(directory):
+            CATALOGUE.lock_album(directory)
+            locked.append(directory)
+
+        lock_directory(path)
+        try:
+            # create the Album object: it is always read from disk and then
+            # dropped from the catalogue
+            Album(path).check(jobs, lock_directory)
+        finally:
+            for directory in locked:
+                CATALOGUE.discard(directory)
+                CATALOGUE.unlock_album(directory)
 
 
     def infer_album(self, args):
@@ -518,16 +838,24 @@ class ActionExecutor:
         '''Infer the tracklist'''
         
         if not os.path.isdir(args.path):
-            raise argparse.ArgumentError("'{0}' is not a valid path".format(args.path))
+            raise Exception("'{0}' is not a valid path".format(args.path))
 
         if not os.access(args.path, os.R_OK):
-            raise argparse.ArgumentError("'{0}' is not a readable dir".format(args.path))
+            raise Exception("'{0}' is not a readable dir".format(args.path))
         
+        tracklist = []
+
         for track in sorted(os.listdir(args.path)):
             
             if re.match('.*\.(mp3|m4a|ogg)$', track):
                 
-                print(os.path.splitext(track[int(args.chars):])[0].replace('_', ' ').capitalize())
+                tracklist.append(os.path.splitext(track[int(args.chars):])[0].replace('_', ' ').capitalize())
+
+        if OUTPUT.format == u'json':
+            emit_event(u'tracklist', tracklist = tracklist)
+        else:
+            for title in tracklist:
+                print(title)
 
 
     def test(self, args):
@@ -535,11 +863,11 @@ class ActionExecutor:
         '''Test the progam (used for debugging)'''
 
         # check if the global variables contain Unicode strings
-        print("### Checking global variables")
+        print_header("Checking global variables")
         g = globals()
         for key in g:
             if type(g[key]) == str:
-                print("Non-Unicode string: " + key)
+                print_item("Non-Unicode string: " + key)
 
         # create a temporary album
         tmp_album_dir = unicode(tempfile.mkdtemp(prefix = "musyc-"), "UTF-8")
@@ -575,20 +903,19 @@ class ActionExecutor:
         out.close()
 
         # execute a complete check on the just created album
-        print("### Checking the variables of a temporary album")
+        print_header("Checking the variables of a temporary album")
         
-        print("Album name: " + self.targetdir)
-        print("Content:")
+        print_item("Album name: " + self.targetdir)
         for f in os.listdir(tmp_album_dir):
-            print("- " + f)
+            print_item("Content: " + f)
             
-        print("Performing checks:")
+        print_header("Performing checks")
         album = Album(self.targetdir)
         for key in album.__dict__:
             if type(album.__dict__[key]) == str:
-                print("Non-Unicode strings: " + key)
+                print_item("Non-Unicode strings: " + key)
             elif album.__dict__[key] == None:
-                print("Empty:               " + key)
+                print_item("Empty:               " + key)
         shutil.rmtree(tmp_album_dir)
 
 
@@ -602,16 +929,230 @@ class ActionExecutor:
         '''Perform a consistency check on the given album'''
     
         if not os.path.isdir(args.path):
-            raise argparse.ArgumentError("'{0}' is not a valid path".format(args.path))
+            raise Exception("'{0}' is not a valid path".format(args.path))
 
         if not os.access(args.path, os.R_OK):
-            raise argparse.ArgumentError("'{0}' is not a readable dir".format(args.path))
+            raise Exception("'{0}' is not a readable dir".format(args.path))
 
         # determine the path to the metadata file
         path = unicode(os.path.realpath(args.path), "utf-8")
         
         # create the Album object
-        Album(path).dump()
+        CATALOGUE.get(path).dump()
+
+
+    def query(self, args):
+
+        '''Dump the albums of the library matching the given filters'''
+
+        if not os.path.isdir(args.path):
+            raise Exception("'{0}' is not a valid path".format(args.path))
+
+        if not os.access(args.path, os.R_OK):
+            raise Exception("'{0}' is not a readable dir".format(args.path))
+
+        root = unicode(os.path.realpath(args.path), "utf-8")
+
+        for item in sorted(os.listdir(root)):
+
+            album_dir = os.path.realpath(os.path.join(root, item))
+
+            # consider only the directories containing an album
+            if not os.path.isfile(os.path.join(album_dir, METADATA_FILE)):
+                continue
+
+            try:
+                album = CATALOGUE.get(album_dir)
+            except Exception, e:
+                # the album may have been renamed by a check in the meantime
+                if os.path.isdir(album_dir):
+                    print_error(unicode(e))
+                continue
+
+            if album.matches(author = args.author, title = args.title, year = args.year, genre = args.genre):
+                album.dump()
+
+
+    def serve(self, args):
+
+        '''Answer the requests of other programs until interrupted'''
+
+        # stop cleanly also when terminated by a service manager
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        if args.socket is not None:
+            # remove the socket left behind by a server that was killed, but
+            # never the one of a server that is still running
+            if os.path.exists(args.socket) and stat.S_ISSOCK(os.stat(args.socket).st_mode):
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    probe.connect(args.socket)
+                except socket.error, e:
+                    if e.errno != errno.ECONNREFUSED:
+                        raise
+                    os.remove(args.socket)
+                else:
+                    raise Exception("'{0}' is used by another server".format(args.socket))
+                finally:
+                    probe.close()
+            server = UnixRequestServer(args.socket, RequestHandler)
+            address = args.socket
+        else:
+            server = TCPRequestServer((args.host, args.port), RequestHandler)
+            address = "http://{0}:{1}/".format(args.host, args.port)
+
+        if OUTPUT.format == u'json':
+            emit_event(u'listening', address = address)
+        else:
+            print("Listening on " + address)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if args.socket is not None and os.path.exists(args.socket):
+                os.remove(args.socket)
+
+
+##########
+# SERVER #
+##########
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+
+    '''
+    Answer the HTTP requests in the form:
+    GET /<command>?<argument>=<value>&...
+    with the list of the JSON events produced by the command.
+    The commands that modify the albums must be sent with POST, passing
+    the arguments in the query string or in a form-encoded body.
+    '''
+
+
+    # command -> (action, default arguments)
+    READ_COMMANDS = {
+        'dump':   ('dump',         { 'path': '.' }),
+        'query':  ('query',        { 'path': '.', 'author': None, 'title': None, 'year': None, 'genre': None }),
+        'genres': ('print_genres', {}),
+    }
+
+    WRITE_COMMANDS = {
+        'check':  ('check_album',  { 'path': '.', 'jobs': 1 }),
+    }
+
+
+    def do_GET(self):
+
+        self.execute(self.READ_COMMANDS, self.WRITE_COMMANDS, '')
+
+
+    def do_POST(self):
+
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.execute(self.WRITE_COMMANDS, self.READ_COMMANDS, self.rfile.read(length))
+
+
+    def execute(self, commands, other_commands, body):
+
+        '''Execute the requested command, if it is allowed for the method'''
+
+        url = urlparse.urlparse(self.path)
+        command = url.path.strip('/')
+
+        # browsers always send the Origin header on cross-site requests:
+        # refuse them, so that web pages cannot drive the server
+        if self.headers.getheader('Origin') is not None:
+            self.reply(403, [ { 'event': u'error', 'message': u"Cross-origin requests are not allowed" } ])
+            return
+
+        # a page served under another name that resolves to this server (DNS
+        # rebinding) sends no Origin, but it cannot fake the Host header
+        if self.server.allowed_hosts is not None and self.headers.getheader('Host') not in self.server.allowed_hosts:
+            self.reply(403, [ { 'event': u'error', 'message': u"Host '{0}' is not allowed".format(self.headers.getheader('Host')) } ])
+            return
+
+        if command in other_commands:
+            self.reply(405, [ { 'event': u'error', 'message': u"Command '{0}' does not accept {1}".format(command, self.command) } ])
+            return
+
+        if command not in commands:
+            self.reply(404, [ { 'event': u'error', 'message': u"Unknown command '{0}'".format(command) } ])
+            return
+
+        action, defaults = commands[command]
+
+        # every argument is given at most once, unknown ones are ignored
+        kwargs = dict(defaults)
+        for query in (url.query, body):
+            for key, values in urlparse.parse_qs(query).items():
+                if key in kwargs:
+                    kwargs[key] = values[-1]
+
+        # collect the output of the command instead of printing it
+        OUTPUT.format = u'json'
+        OUTPUT.events = []
+        OUTPUT.album  = None
+        OUTPUT.stage  = None
+
+        status = 200
+        try:
+            getattr(ActionExecutor(), action)(argparse.Namespace(**kwargs))
+        except Exception, e:
+            status = 500
+            print_error(unicode(e))
+
+        self.reply(status, OUTPUT.events)
+
+
+    def reply(self, status, events):
+
+        body = json.dumps({ 'events': events })
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TCPRequestServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    '''Server listening on a TCP port, one thread per request'''
+
+    daemon_threads = True
+
+    def server_bind(self):
+
+        BaseHTTPServer.HTTPServer.server_bind(self)
+
+        # the values of the Host header that address this server directly
+        host, port = self.server_address[:2]
+        self.allowed_hosts = set()
+        for name in (host, 'localhost', '127.0.0.1'):
+            self.allowed_hosts.add('{0}:{1}'.format(name, port))
+            if port == 80:
+                self.allowed_hosts.add(name)
+
+
+class UnixRequestServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    '''Server listening on a Unix socket, one thread per request'''
+
+    daemon_threads = True
+
+    # browsers cannot reach a Unix socket, the Host header is not checked
+    allowed_hosts = None
+
+    def get_request(self):
+
+        # the clients of a Unix socket have no address, but the request
+        # handler logs it as a (host, port) pair
+        conn, address = self.socket.accept()
+        return conn, ('unix', 0)
 
 
 ########################
@@ -639,6 +1180,8 @@ class ArgumentParser(argparse.ArgumentParser):
             self.subparsers = self.add_subparsers(title = 'subcommands', help = 'Additional help')
 
             #self.add_argument('--trace', help = 'Show the stack trace in case of errors')
+
+            self.add_argument('--format', help = 'Specify the output format', choices = ('text', 'json'), default = 'text')
             
             init_parser = self.subparsers.add_parser('init')
             init_parser.add_argument('--path', help = 'Specify target path', default = '.')
@@ -646,6 +1189,7 @@ class ArgumentParser(argparse.ArgumentParser):
         
             check_parser = self.subparsers.add_parser('check')
             check_parser.add_argument('--path', help = 'Specify target path', default = '.')
+            check_parser.add_argument('--jobs', help = 'Specify the number of tracks whose tags are written at the same time', type = positive_int, default = 1)
             check_parser.set_defaults(func = ns.check_album)
             
             infer_parser = self.subparsers.add_parser('infer')
@@ -665,11 +1209,26 @@ class ArgumentParser(argparse.ArgumentParser):
             dump_parser = self.subparsers.add_parser('dump')
             dump_parser.add_argument('--path', help = 'Specify target path', default = '.')
             dump_parser.set_defaults(func = ns.dump)
+
+            query_parser = self.subparsers.add_parser('query')
+            query_parser.add_argument('--path', help = 'Specify the library path', default = '.')
+            query_parser.add_argument('--author', help = 'Select the albums of the given author')
+            query_parser.add_argument('--title', help = 'Select the albums with the given title')
+            query_parser.add_argument('--year', help = 'Select the albums published in the given year')
+            query_parser.add_argument('--genre', help = 'Select the albums of the given genre')
+            query_parser.set_defaults(func = ns.query)
+
+            serve_parser = self.subparsers.add_parser('serve')
+            serve_parser.add_argument('--host', help = 'Specify the address to listen on', default = '127.0.0.1')
+            serve_parser.add_argument('--port', help = 'Specify the port to listen on', type = int, default = 8080)
+            serve_parser.add_argument('--socket', help = 'Listen on the given Unix socket instead of a TCP port')
+            serve_parser.set_defaults(func = ns.serve)
         
             test_parser = self.subparsers.add_parser('test')
             test_parser.set_defaults(func = ns.test)
         
         args = self.parse_args(sys.argv[1:], ns)
+        OUTPUT.format = unicode(args.format)
         args.func(args)
 
 
@@ -686,7 +1245,7 @@ if __name__ == "__main__":
     except Exception, e:
 
         # print an error message
-        print(termcolor.colored('!!! ', 'red', attrs = [ 'bold' ]) + unicode(e))
+        print_error(unicode(e))
 
         # print the stack trace
         #traceback.print_exc(file = sys.stdout)